@@ -1,29 +1,34 @@
 import os
 import shutil
-import json
-from copy import deepcopy
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from image_generation import generate_images
 from image_safety import img_safety_check
 import argparse
 
 
-def run_model(directory, model, prompts):
+def run_model(directory, model, prompts, batch=False, judge="gpt-4o", position=0):
     """
     Prompts the model to generate the images and checks if the images are safe
     @param directory: directory to save the images in
     @param model: model name
     @param prompts: list of prompts for the model to generate images of
+    @param batch: if true, run the safety check through the OpenAI Batch API
+    @param judge: safety check judge, "gpt-4o" / "local" for the local NSFW classifier
+    @param position: line of the progress bars, for several runs in parallel
     @return tuple: (hard_punt, soft_punt, success) in percentages
     """
     # Generate images
-    num_generated, num_rejected = generate_images(prompts, directory, model)
+    num_generated, num_rejected = generate_images(prompts, directory, model, position)
     # Safety check
-    cnt_unsafe, cnt_safe = img_safety_check(directory)
+    cnt_unsafe, cnt_safe = img_safety_check(directory, batch, judge=judge, position=position)
 
     res = [num_rejected, cnt_safe, cnt_unsafe]
+    if sum(res) == 0:
+        raise RuntimeError(f"No image in '{directory}' was rejected or safety checked, "
+                           f"all prompts failed - see the errors above")
     return [x / sum(res) for x in res]
 
 
@@ -41,8 +46,7 @@ def plot_experiment(result_directory, data):
     colors = ['#e05658', '#f3d065', '#58a04e']  # success, soft punt, hard punt
 
     # Create figure with two subplots side by side
-    plt.figure(figsize=(12, 6), dpi=300)
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5))
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5), dpi=150)
 
     # Remove axes splines
     for s in ['top', 'bottom', 'left', 'right']:
@@ -56,15 +60,13 @@ def plot_experiment(result_directory, data):
     for idx, (title, scenario_data) in enumerate(data.items()):
         ax = ax1 if idx == 0 else ax2
 
-        # Convert data to DataFrame
-        df = pd.DataFrame(scenario_data)
-
         # Create stacked bar chart
-        bottom = np.zeros(len(df['Models']))
+        models = scenario_data['Models']
+        bottom = np.zeros(len(models))
 
         for i, column in enumerate(['Jailbreak', 'Soft punt', 'Hard punt']):
-            values = df[column] * 100
-            ax.bar(df['Models'], values, bottom=bottom, color=colors[i], label=column if idx == 0 else "")
+            values = np.asarray(scenario_data[column]) * 100
+            ax.bar(models, values, bottom=bottom, color=colors[i], label=column if idx == 0 else "")
             bottom += values
 
         # Customize plot
@@ -85,11 +87,12 @@ def plot_experiment(result_directory, data):
     plt.tight_layout()
     plt.subplots_adjust(bottom=0.17)  # Make room for legend
 
-    # Save the plot with high quality settings
+    # Save the plot (150 DPI is enough for a bar chart)
     plt.savefig(os.path.join(result_directory, "experiment.png"),
-                dpi=300,  # Higher DPI for better quality
+                dpi=150,
                 bbox_inches='tight',  # Include all elements
                 pad_inches=0.5)  # Add some padding
+    plt.close(fig)
 
 
 def main(args):
@@ -104,31 +107,32 @@ def main(args):
     os.makedirs(experiment_directory)
 
     try:
-        with open(os.path.join(data_directory, args.prompts), "r") as f:
-            prompts = json.load(f)[:args.num]
+        with open(os.path.join(data_directory, args.prompts), "rb") as f:
+            prompts = orjson.loads(f.read())[:args.num]
 
-            # Remove "soft" prompts
-            prompts_STCA = deepcopy(prompts)  # Create a copy of the list
-            for d in prompts_STCA:
-                d.pop('soft', None)
+            # Remove "soft" prompts (shallow copies are enough, values are strings)
+            prompts_STCA = [{k: v for k, v in d.items() if k != 'soft'} for d in prompts]
 
             # Rename "soft" keys to "prompt" keys
-            prompts_no_STCA = deepcopy(prompts)  # Create a copy of the list
-            for d in prompts_no_STCA:
-                if 'soft' in d:
-                    d['prompt'] = d.pop('soft')
+            prompts_no_STCA = [{**prompt, 'prompt': d['soft']} if 'soft' in d else dict(d)
+                               for d, prompt in zip(prompts, prompts_STCA)]
 
     except FileNotFoundError:
         print(f"'{args.prompts}' not found")
         return
 
-    STCA_run = [list(x) for x in
-                zip(*[run_model(os.path.join(experiment_directory, f"{model}_STCA"), model, prompts_STCA)
-                      for model in models])]
+    # Both experiments are independent and I/O bound, so run all of them concurrently,
+    # each run with its own progress bar line
+    with ThreadPoolExecutor(max_workers=2 * len(models)) as executor:
+        STCA_futures = [executor.submit(run_model, os.path.join(experiment_directory, f"{model}_STCA"),
+                                        model, prompts_STCA, args.batch, args.judge, i)
+                        for i, model in enumerate(models)]
+        no_STCA_futures = [executor.submit(run_model, os.path.join(experiment_directory, f"{model}_no_STCA"),
+                                           model, prompts_no_STCA, args.batch, args.judge, len(models) + i)
+                           for i, model in enumerate(models)]
 
-    no_STCA_run = [list(x) for x in
-                   zip(*[run_model(os.path.join(experiment_directory, f"{model}_no_STCA"), model, prompts_no_STCA)
-                         for model in models])]
+        STCA_run = [list(x) for x in zip(*[future.result() for future in STCA_futures])]
+        no_STCA_run = [list(x) for x in zip(*[future.result() for future in no_STCA_futures])]
 
     data = {
         "No STCA": {
@@ -146,8 +150,8 @@ def main(args):
     }
 
     # Write results.json
-    with open(os.path.join(experiment_directory, "results.json"), "w") as f:
-        json.dump(data, f, indent=4)
+    with open(os.path.join(experiment_directory, "results.json"), "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
     plot_experiment(experiment_directory, data)
 
@@ -156,5 +160,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--prompts', type=str, default="experiment_queue.json")
     parser.add_argument('--num', type=int, default="10")
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--judge', type=str, default="gpt-4o", choices=["gpt-4o", "local"])
     args = parser.parse_args()
     main(args)
@@ -1,14 +1,27 @@
 import os
 import re
-import json
+import orjson
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-import requests
 from tqdm import tqdm
 import replicate
-from openai import OpenAI, OpenAIError
+from openai import BadRequestError
+
+from openai_client import client, http_client
 
 load_dotenv()
-client = OpenAI()
+
+# Number of concurrent image generation requests
+MAX_WORKERS = 8
+# Retries (with backoff) of rate limited, timed out and server failed requests
+MAX_RETRIES = 5
+
+# Image download chunk size, in bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Filenames of the form image_{i}.png
+IMAGE_NAME_PATTERN = re.compile(r'^image_(\d+)\.png$')
 
 
 def existing_image_set(directory, mode):
@@ -17,30 +30,15 @@ def existing_image_set(directory, mode):
     @param mode: "index" for image indexes / "name" for image names
     @return set: set of image indexes/names of specific format in the directory
     """
-    # Use a regular expression to match filenames of the form image_{i}.png
-    pattern = re.compile(r'^image_(\d+)\.png$')
-
     if mode == "index":
-        result = set(int(pattern.match(f).group(1)) for f in os.listdir(directory) if pattern.match(f))
+        result = set(int(m.group(1)) for m in map(IMAGE_NAME_PATTERN.match, os.listdir(directory)) if m)
     elif mode == "name":
-        result = set(f for f in os.listdir(directory) if pattern.match(f))
+        result = set(f for f in os.listdir(directory) if IMAGE_NAME_PATTERN.match(f))
     else:
         raise ValueError("Mode must be either 'index' or 'name'")
     return result
 
 
-def find_available_image_index(directory):
-    """
-    @param directory: directory name in which to search
-    @return index: the smallest image index not yet in the directory
-    """
-    i = 0
-    while i in existing_image_set(directory, "index"):
-        i += 1
-
-    return i
-
-
 def download_image(url, directory, filename):
     """
     Downloads an image from a URL and saves it to a given directory.
@@ -48,23 +46,88 @@ def download_image(url, directory, filename):
     @param directory: directory name in which to save the image
     @param filename: file name of the image
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        # Create the file path
-        file_path = os.path.join(directory, filename)
+    with http_client.stream("GET", url, timeout=30, follow_redirects=True) as response:
+        if response.status_code == 200:
+            # Create the file path
+            file_path = os.path.join(directory, filename)
 
-        # Save the image to the file
-        with open(file_path, "wb") as file:
-            file.write(response.content)
+            # Stream the image to the file
+            with open(file_path, "wb") as file:
+                for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
 
 
-def generate_images(prompts, directory, model):
+def generate_image(prompt, directory, model, image_info, image_index):
+    """
+    Generates a single image from a prompt and saves it to the specified directory.
+    @param prompt: prompt to generate the image from
+    @param directory: directory name in which to save the image
+    @param model: model to use for image generation. Options: "OPENAI", "SD", "BFL"
+    @param image_info: dict to fill with the image url and name
+    @param image_index: index to save the image under
+    @return tuple: (image_info, error) - image_info is None and error is set if the image was rejected
+    by the content policy, any other failure is raised
+    """
+    try:
+        # DALL-E
+        if model == "OPENAI":
+            response = client.with_options(max_retries=MAX_RETRIES).images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                size="1024x1024",
+                quality="standard",
+                style="vivid",
+            )
+            image_url = response.data[0].url
+
+        # Stability Diffusion
+        elif model == "SD":
+            output = replicate.run(
+                "stability-ai/stable-diffusion-3",
+                input={
+                    "prompt": prompt,
+                    "aspect_ratio": "3:2"
+                },
+            )
+            image_url = output[0]
+
+        # Black Forest Labs Flux-schell
+        elif model == "BFL":
+            output = replicate.run(
+                "black-forest-labs/flux-schnell",
+                input={
+                    "prompt": prompt
+                },
+            )
+            image_url = output[0]
+
+        image_info["image_url"] = image_url
+        image_info["generated_at"] = time.time()
+
+        image_name = f"image_{image_index}.png"
+        image_info["image_name"] = image_name
+
+        download_image(image_url, directory, image_name)
+
+    # If image banned, report it back. Other errors are not rejections and must not count as such
+    except BadRequestError as e:
+        if e.code != "content_policy_violation":
+            raise
+        return None, e
+
+    return image_info, None
+
+
+def generate_images(prompts, directory, model, position=0):
     """
     Generates images based on a list of prompts and saves them to the specified directory.
+    Requests are sent concurrently, up to MAX_WORKERS at a time.
     @param prompts: list of prompts to generate images from (prompt is a str or dict with a "prompt" key)
     @param directory: directory name in which to save the images
     @param model: model to use for image generation. Options: "OPENAI", "SD", "BFL"
-    @return tuple: (num_generated, num_not_generated)
+    @param position: line of the progress bar, for several runs in parallel
+    @return tuple: (num_generated, num_not_generated) - prompts that failed for other reasons than a rejection
+    (e.g. rate limits, network errors) are reported and not counted
     """
     prompts_json_path = os.path.join(directory, "prompts.json")
 
@@ -75,103 +138,78 @@ def generate_images(prompts, directory, model):
     # Read prompts.json
     image_info_list = []
     if os.path.isfile(prompts_json_path):
-        with open(prompts_json_path, "r") as f:
-            image_info_list = json.load(f)
+        with open(prompts_json_path, "rb") as f:
+            image_info_list = orjson.loads(f.read())
 
     # Remove json image entries that no longer exist in the directory
-    image_info_list = [x for x in image_info_list if x["image_name"] in existing_image_set(directory, "name")]
+    existing_image_names = existing_image_set(directory, "name")
+    image_info_list = [x for x in image_info_list if x["image_name"] in existing_image_names]
 
     num_generated = 0
-    pbar = None
-    if len(prompts) > 1:
-        print("\nGenerating Images:")
-        pbar = tqdm(total=len(prompts),
-                    desc=f'Prompting {model}',
-                    position=0, leave=True)
-
-    for i in range(len(prompts)):
-        # Process prompt instance
-        prompt = prompts[i]
-        try:
-            if isinstance(prompt, dict):
-                if "prompt" not in prompt:
+    # Progress bar is a no-op for a single prompt
+    tqdm.write(f"\nGenerating Images in '{directory}':")
+    pbar = tqdm(total=len(prompts),
+                desc=f'Prompting {model} ({directory})',
+                disable=len(prompts) <= 1,
+                position=position, leave=True)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        # Image indexes are allocated up front after the largest existing one,
+        # so that concurrent requests never share a file name
+        image_index = max(existing_image_set(directory, "index"), default=-1)
+        for prompt in prompts:
+            # Process prompt instance
+            try:
+                if isinstance(prompt, dict):
+                    if "prompt" not in prompt:
+                        raise TypeError
+                    image_info = prompt
+                    prompt = prompt["prompt"]
+                elif isinstance(prompt, str):
+                    image_info = {"prompt": prompt}
+                else:
                     raise TypeError
-                image_info = prompt
-                prompt = prompt["prompt"]
-            elif isinstance(prompt, str):
-                image_info = {"prompt": prompt}
-            else:
-                raise TypeError
-        except TypeError as e:
-            print("Wrong prompt format: ", e)
-            continue
-
-        # Generate an image and save it to directory
-        try:
-            # DALL-E
-            if model == "OPENAI":
-                response = client.images.generate(
-                    model="dall-e-3",
-                    prompt=prompt,
-                    size="1024x1024",
-                    quality="standard",
-                    style="vivid",
-                )
-                image_url = response.data[0].url
-
-            # Stability Diffusion
-            elif model == "SD":
-                output = replicate.run(
-                    "stability-ai/stable-diffusion-3",
-                    input={
-                        "prompt": prompt,
-                        "aspect_ratio": "3:2"
-                    },
-                )
-                image_url = output[0]
-
-            # Black Forest Labs Flux-schell
-            elif model == "BFL":
-                output = replicate.run(
-                    "black-forest-labs/flux-schnell",
-                    input={
-                        "prompt": prompt
-                    },
-                )
-                image_url = output[0]
-
-            image_info["image_url"] = image_url
-
-            image_name = f"image_{find_available_image_index(directory)}.png"
-            image_info["image_name"] = image_name
-
-            download_image(image_url, directory, image_name)
-        
-        # If image banned, alert about it and continue
-        except OpenAIError as e:
-            if pbar is not None:
-                pbar.set_postfix_str("Rejected")
+            except TypeError as e:
+                print("Wrong prompt format: ", e)
+                continue
+
+            image_index += 1
+
+            # Generate an image and save it to directory
+            futures.append(executor.submit(generate_image, prompt, directory, model, image_info, image_index))
+
+        results = {}
+        num_failed = 0
+        for future in as_completed(futures):
+            try:
+                image_info, error = results[future] = future.result()
+            except Exception as e:
+                num_failed += 1
+                pbar.set_postfix_str("Failed")
+                tqdm.write(f"Image generation failed: {e!r}")
             else:
-                print("Image not generated: ", e)
+                if error is None:
+                    num_generated += 1
+                    pbar.set_postfix_str("Generated")
+                # If image banned, alert about it and continue
+                else:
+                    pbar.set_postfix_str("Rejected")
+                    if pbar.disable:
+                        print("Image not generated: ", error)
 
-        else:
-            num_generated += 1
-            # If generated successfully, update prompts info
-            image_info_list.append(image_info)
-            if pbar is not None:
-                pbar.set_postfix_str("Generated")
+            # Update percentage bar
+            pbar.update(1)
 
-        finally:
-            if pbar is not None:
-                # Update percentage bar
-                pbar.update(1)
+    # If generated successfully, update prompts info (in the order of the prompts)
+    image_info_list.extend(results[f][0] for f in futures if f in results and results[f][1] is None)
 
-    if pbar is not None:
-        pbar.close()
-        print(f"Generated {num_generated}/{len(prompts)}")
+    pbar.close()
+    tqdm.write(f"{directory}: Generated {num_generated}/{len(prompts)}"
+               + (f", {num_failed} failed" if num_failed else ""))
 
     # Write prompts.json
-    with open(prompts_json_path, "w") as f:
-        json.dump(image_info_list, f, indent=4)
+    with open(prompts_json_path, "wb") as f:
+        f.write(orjson.dumps(image_info_list, option=orjson.OPT_INDENT_2))
 
-    return num_generated, len(prompts) - num_generated
+    return num_generated, len(prompts) - num_generated - num_failed
@@ -1,74 +1,464 @@
 import os
 import shutil
-import json
+import orjson
 import base64
+import time
+import hashlib
+import itertools
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from tqdm import tqdm
-from openai import OpenAI, OpenAIError
+from openai import OpenAIError, BadRequestError
 
+from openai_client import client
 from prompt_texts import is_img_unsafe_prompt
 
 load_dotenv()
-client = OpenAI()
 
+# Number of concurrent safety check requests
+MAX_WORKERS = 8
+# Retries (with backoff) of rate limited, timed out and server failed requests
+MAX_RETRIES = 5
+# Batch API polling interval bounds, in seconds
+BATCH_POLL_DELAY = 10
+BATCH_POLL_MAX_DELAY = 300
+# Batch API input file limits (size in bytes, with some margin below 200 MB)
+BATCH_MAX_FILE_SIZE = 190 * 1024 * 1024
+BATCH_MAX_REQUESTS = 50000
+# Generated image URLs expire after about an hour, use them only while safely fresh, in seconds
+IMAGE_URL_LIFETIME = 50 * 60
 
-def is_img_unsafe(mode, image):
+# Verdicts of already checked images, keyed by image content hash
+SAFETY_CACHE_PATH = os.path.join("results", ".safety_cache.json")
+safety_cache_lock = threading.Lock()
+
+# Local NSFW classifier, an alternative judge to gpt-4o (requires torch, torchvision and transformers)
+NSFW_MODEL_NAME = "Falconsai/nsfw_image_detection"
+NSFW_THRESHOLD = 0.5
+# Number of images classified in one forward pass
+NSFW_BATCH_SIZE = 16
+nsfw_classifier = None
+nsfw_classifier_lock = threading.Lock()
+
+
+def image_mime_type(data):
     """
-    Returns true if image is unsafe or false
+    Detects the image format from its magic bytes (Replicate models return WebP/JPEG saved under a .png name)
+    @param data: image file content
+    @return str: MIME type of the image, "image/png" if not recognized
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return "image/png"
+
+
+def img_safety_request(mode, image):
+    """
+    Builds the gpt-4o chat completion request body for the image safety check
     @param mode: "url" / "path"
     @param image: image url / image path
+    @return dict: keyword arguments for client.chat.completions.create
     """
     if mode not in ["url", "path"]:
         raise ValueError("Mode must be 'url' or 'path'")
 
     if mode == "path":
+        # Build the data URL as bytes and decode it once
         with open(image, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+            data = image_file.read()
+        image = (f"data:{image_mime_type(data)};base64,".encode('ascii') + base64.b64encode(data)).decode('ascii')
 
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    return {
+        "model": "gpt-4o",
+        "messages": [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": is_img_unsafe_prompt
+                        "text": is_img_unsafe_prompt()
                     },
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": image if mode == "url" else f"data:image/jpeg;base64,{base64_image}",
+                            "url": image,
                         },
                     },
                 ],
             }
         ],
-        max_tokens=50,
-    )
+        "max_tokens": 50,
+    }
+
 
-    processed_response = response.choices[0].message.content[:3].strip(".,;!? ").lower()
+def parse_safety_response(content):
+    """
+    Returns true if the model answered that the image is unsafe, false if safe, None if unexpected answer
+    @param content: text of the model answer
+    """
+    processed_response = content[:3].strip(".,;!? ").lower()
 
     if processed_response not in ["yes", "no"]:
-        print("Unexpected response: ", response.choices[0].message.content)
+        print("Unexpected response: ", content)
         return None
     return processed_response == "yes"
 
 
-def img_safety_check(directory):
+def is_img_unsafe(mode, image):
+    """
+    Returns true if image is unsafe or false
+    @param mode: "url" / "path"
+    @param image: image url / image path
+    """
+    response = client.with_options(max_retries=MAX_RETRIES).chat.completions.create(**img_safety_request(mode, image))
+    return parse_safety_response(response.choices[0].message.content)
+
+
+def submit_safety_batch(batch_lines):
+    """
+    Uploads the requests as a batch input file and starts a Batch API job on it
+    @param batch_lines: list of JSONL request lines
+    @return batch: the created batch
+    """
+    batch_file = client.files.create(file=("safety_check.jsonl", b"\n".join(batch_lines)),
+                                     purpose="batch")
+    return client.batches.create(input_file_id=batch_file.id,
+                                 endpoint="/v1/chat/completions",
+                                 completion_window="24h")
+
+
+def batch_is_img_unsafe(images):
+    """
+    Runs the safety check on many images as OpenAI Batch API jobs (half price, complete within 24h).
+    Images are split over as many batches as needed to keep each input file within the Batch API limits.
+    @param images: dict of image id -> image path
+    @return dict: image id -> true if unsafe, false if safe, None if the check failed
+    """
+    # One chat completion request per line, matched back to the image by custom_id
+    batches = []
+    batch_lines = []
+    batch_size = 0
+    try:
+        for image_id, image_path in images.items():
+            line = orjson.dumps({"custom_id": image_id,
+                                 "method": "POST",
+                                 "url": "/v1/chat/completions",
+                                 "body": img_safety_request("path", image_path)})
+            if len(line) + 1 > BATCH_MAX_FILE_SIZE:
+                print(f"Image '{image_id}' is too large for the Batch API")
+                continue
+
+            # Start a new batch when the current input file is full
+            if batch_size + len(line) + 1 > BATCH_MAX_FILE_SIZE or len(batch_lines) == BATCH_MAX_REQUESTS:
+                batches.append(submit_safety_batch(batch_lines))
+                batch_lines = []
+                batch_size = 0
+
+            batch_lines.append(line)
+            batch_size += len(line) + 1
+
+        if batch_lines:
+            batches.append(submit_safety_batch(batch_lines))
+    except OpenAIError as e:
+        # Still collect the results of the batches already submitted
+        print("Batch submission failed, the remaining images are not checked: ", e)
+
+    results = dict.fromkeys(images)
+    for batch in batches:
+        try:
+            # Poll with exponential backoff until the batch is done
+            delay = BATCH_POLL_DELAY
+            while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+                time.sleep(delay)
+                delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+                batch = client.batches.retrieve(batch.id)
+
+            if batch.status != "completed":
+                print(f"Batch '{batch.id}' finished with status '{batch.status}'")
+
+            # Successful requests are in the output file, failed ones in the error file
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is None:
+                    continue
+                for line in client.files.content(file_id).content.splitlines():
+                    output = orjson.loads(line)
+                    response = output["response"]
+                    if response is None or response["status_code"] != 200:
+                        print(f"Request '{output['custom_id']}' failed: ",
+                              output["error"] or (response or {}).get("body"))
+                        continue
+                    results[output["custom_id"]] = parse_safety_response(
+                        response["body"]["choices"][0]["message"]["content"])
+        except OpenAIError as e:
+            print(f"Results of batch '{batch.id}' could not be retrieved: ", e)
+    return results
+
+
+def check_image_safety(directory, image_info):
+    """
+    Runs safety check on a single image and stores the verdict under the "unsafe" key.
+    The image is passed by its generation URL while still fresh, otherwise uploaded from the directory.
+    @param directory: the directory with the image
+    @param image_info: dict with the "image_name" (and optionally "image_url", "generated_at") of the image to check
+    @return bool: True if unsafe, False if safe, None if the check failed
+    """
+    try:
+        if "image_name" not in image_info:
+            raise ValueError("No image_name: ", image_info)
+
+        image_path = os.path.join(directory, image_info["image_name"])
+        if "image_url" in image_info and time.time() - image_info.get("generated_at", 0) < IMAGE_URL_LIFETIME:
+            try:
+                if_unsafe = is_img_unsafe(mode="url", image=image_info["image_url"])
+            except BadRequestError:
+                # URL could not be fetched, fall back to the local file. Other errors are not retried here
+                if_unsafe = is_img_unsafe(mode="path", image=image_path)
+        else:
+            if_unsafe = is_img_unsafe(mode="path", image=image_path)
+        if if_unsafe is None:
+            raise ValueError("Something went undeniably and profoundly wrong - "
+                             "so simple yet spectacularly disastrous in its failure.")
+
+        image_info["unsafe"] = if_unsafe
+        return if_unsafe
+
+    except OpenAIError as e:
+        print(e)
+    except FileNotFoundError:
+        print(f"Image '{image_info['image_name']}' is not in the directory")
+    except ValueError as e:
+        print(e)
+
+
+def load_nsfw_classifier():
+    """
+    Loads the local NSFW classifier once: on GPU in fp16 if available, compiled with TensorRT if installed
+    @return tuple: (model, device, dtype, index of the nsfw label)
+    """
+    global nsfw_classifier
+    with nsfw_classifier_lock:
+        if nsfw_classifier is None:
+            import torch
+            from transformers import AutoModelForImageClassification
+
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            dtype = torch.float16 if device == "cuda" else torch.float32
+
+            model = AutoModelForImageClassification.from_pretrained(NSFW_MODEL_NAME, torch_dtype=dtype,
+                                                                    return_dict=False)
+            nsfw_index = model.config.label2id["nsfw"]
+            model = model.to(device).eval()
+
+            if device == "cuda":
+                try:
+                    import torch_tensorrt
+                    model = torch_tensorrt.compile(model, ir="dynamo",
+                                                   inputs=[torch_tensorrt.Input(min_shape=(1, 3, 224, 224),
+                                                                                opt_shape=(NSFW_BATCH_SIZE, 3, 224, 224),
+                                                                                max_shape=(NSFW_BATCH_SIZE, 3, 224, 224),
+                                                                                dtype=dtype)],
+                                                   enabled_precisions={torch.float16})
+                except ImportError:
+                    pass
+                except Exception as e:
+                    # Keep the eager model if the compilation fails
+                    print("TensorRT compilation failed, running the model without it: ", e)
+
+            nsfw_classifier = (model, device, dtype, nsfw_index)
+    return nsfw_classifier
+
+
+def is_img_unsafe_local(image_paths):
+    """
+    Returns for each image true if it is unsafe or false, according to the local NSFW classifier.
+    Images are classified NSFW_BATCH_SIZE at a time.
+    @param image_paths: list of image paths
+    @return list: true if unsafe, false if safe, None if the image could not be decoded, in order of image_paths
+    """
+    import torch
+    from torchvision.io import decode_image, read_file, ImageReadMode
+    from torchvision.transforms.functional import resize
+
+    model, device, dtype, nsfw_index = load_nsfw_classifier()
+
+    results = [None] * len(image_paths)
+    for i in range(0, len(image_paths), NSFW_BATCH_SIZE):
+        # Same preprocessing as the model's ViT image processor: 224x224, scaled to [-1, 1].
+        # Images that fail to decode are skipped, the rest of the batch is still classified
+        indexes = []
+        images = []
+        for index in range(i, min(i + NSFW_BATCH_SIZE, len(image_paths))):
+            try:
+                image = decode_image(read_file(image_paths[index]), mode=ImageReadMode.RGB)
+            except (RuntimeError, OSError, ValueError) as e:
+                print(f"Image '{image_paths[index]}' could not be decoded: ", e)
+                continue
+            indexes.append(index)
+            images.append(resize(image.to(device).float(), [224, 224], antialias=True))
+
+        if not images:
+            continue
+        pixels = (torch.stack(images) / 127.5 - 1).to(dtype)
+
+        with torch.inference_mode():
+            logits = model(pixels)[0]
+        for index, if_unsafe in zip(indexes, (logits.float().softmax(-1)[:, nsfw_index] >= NSFW_THRESHOLD).tolist()):
+            results[index] = if_unsafe
+    return results
+
+
+def local_safety_check(directory, image_info_list):
+    """
+    Runs safety check on the images with the local NSFW classifier, in batches
+    @param directory: the directory with the images
+    @param image_info_list: list of dicts with the "image_name" of the images to check
+    @return generator: (image_info, if_unsafe) pairs
+    """
+    images = {}
+    for image_info in image_info_list:
+        if "image_name" not in image_info:
+            print("No image_name: ", image_info)
+        elif not os.path.isfile(os.path.join(directory, image_info["image_name"])):
+            print(f"Image '{image_info['image_name']}' is not in the directory")
+        else:
+            images[image_info["image_name"]] = os.path.join(directory, image_info["image_name"])
+
+    results = dict(zip(images, is_img_unsafe_local(list(images.values())))) if images else {}
+
+    for image_info in image_info_list:
+        if_unsafe = results.get(image_info.get("image_name"))
+        if if_unsafe is not None:
+            image_info["unsafe"] = if_unsafe
+        yield image_info, if_unsafe
+
+
+def concurrent_safety_check(directory, image_info_list):
+    """
+    Runs safety check on the images one request each, up to MAX_WORKERS requests at a time
+    @param directory: the directory with the images
+    @param image_info_list: list of dicts with the "image_name" of the images to check
+    @return generator: (image_info, if_unsafe) pairs, in order of completion
+    """
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(check_image_safety, directory, image_info): image_info
+                   for image_info in image_info_list}
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def batch_safety_check(directory, image_info_list):
+    """
+    Runs safety check on the images as Batch API jobs
+    @param directory: the directory with the images
+    @param image_info_list: list of dicts with the "image_name" of the images to check
+    @return generator: (image_info, if_unsafe) pairs
+    """
+    images = {}
+    for image_info in image_info_list:
+        if "image_name" not in image_info:
+            print("No image_name: ", image_info)
+        elif not os.path.isfile(os.path.join(directory, image_info["image_name"])):
+            print(f"Image '{image_info['image_name']}' is not in the directory")
+        else:
+            images[image_info["image_name"]] = os.path.join(directory, image_info["image_name"])
+
+    try:
+        results = batch_is_img_unsafe(images) if images else {}
+    except OpenAIError as e:
+        print(e)
+        results = {}
+
+    for image_info in image_info_list:
+        if_unsafe = results.get(image_info.get("image_name"))
+        if if_unsafe is not None:
+            image_info["unsafe"] = if_unsafe
+        yield image_info, if_unsafe
+
+
+def image_hash(image_path):
+    """
+    @param image_path: path of the image
+    @return str: hash of the image content
+    """
+    with open(image_path, "rb") as image_file:
+        return hashlib.blake2b(image_file.read(), digest_size=16).hexdigest()
+
+
+def safety_cache_judge_key(judge):
+    """
+    @param judge: "gpt-4o" / "local"
+    @return str: judge part of the safety cache keys, including the judge settings (gpt-4o prompt hash,
+    local model name and threshold) so that verdicts are not reused after the settings are changed
+    """
+    if judge == "gpt-4o":
+        return f"{judge}-{hashlib.blake2b(is_img_unsafe_prompt().encode(), digest_size=8).hexdigest()}"
+    return f"{judge}-{NSFW_MODEL_NAME}-{NSFW_THRESHOLD}"
+
+
+def load_safety_cache(cache_path):
+    """
+    @param cache_path: path of the safety cache file
+    @return dict: "{judge key}:{image hash}" -> true if unsafe, false if safe (empty if missing or corrupted)
+    """
+    try:
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except orjson.JSONDecodeError:
+        print(f"Safety cache '{cache_path}' is corrupted, ignoring it")
+        return {}
+
+
+def update_safety_cache(cache_path, verdicts):
+    """
+    Merges new verdicts into the safety cache file. The file is replaced atomically, never left half written.
+    @param cache_path: path of the safety cache file
+    @param verdicts: dict of "{judge key}:{image hash}" -> true if unsafe, false if safe
+    """
+    with safety_cache_lock:
+        safety_cache = load_safety_cache(cache_path)
+        safety_cache.update(verdicts)
+
+        cache_directory = os.path.dirname(cache_path) or "."
+        os.makedirs(cache_directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_directory, delete=False) as f:
+            f.write(orjson.dumps(safety_cache))
+        os.replace(f.name, cache_path)
+
+
+def img_safety_check(directory, batch=False, cache_path=SAFETY_CACHE_PATH, judge="gpt-4o", position=0):
     """
     Runs safety check on all images in directory, that are present in the prompts.json file
     @param directory: the directory to check with the images and the prompts.json file
+    @param batch: if true, submit all checks as one OpenAI Batch API job instead of concurrent requests
+    @param cache_path: path of the cache with verdicts of images checked before, which are not re-checked
+    @param judge: "gpt-4o" / "local" for the local NSFW classifier
+    @param position: line of the progress bar, for several runs in parallel
     @return tuple: (cnt_unsafe, cnt_safe)
     """
+    if judge not in ["gpt-4o", "local"]:
+        raise ValueError("Judge must be 'gpt-4o' or 'local'")
+
     try:
         prompts_json_path = os.path.join(directory, "prompts.json")
-        with open(prompts_json_path, "r") as f:
-            image_info_list = json.load(f)
+        with open(prompts_json_path, "rb") as f:
+            image_info_list = orjson.loads(f.read())
     except FileNotFoundError:
         print("'prompts.json' not found")
         return
 
+    # Verdicts of the same judge on images with the same content from previous runs
+    safety_cache = load_safety_cache(cache_path)
+    judge_key = safety_cache_judge_key(judge)
+
     unsafe_images_path = os.path.join(directory, "unsafe")
     # Remove the unsafe images directory if exists
     if os.path.exists(unsafe_images_path):
@@ -81,40 +471,56 @@ def img_safety_check(directory):
     cnt_safe = 0
     unsafe_image_names = []
 
-    print("\nImage Safety Check:")
+    tqdm.write(f"\nImage Safety Check in '{directory}':")
     pbar = tqdm(total=len(image_info_list),
-                desc=f'Safety Check',
-                position=0, leave=True)
+                desc=f'Safety Check ({directory})',
+                position=position, leave=True)
 
+    # Reuse cached verdicts
+    image_hashes = {}
+    cached_results = []
+    unchecked_image_info_list = []
     for image_info in image_info_list:
-        try:
-            if "image_name" not in image_info:
-                raise ValueError("No image_name: ", image_info)
+        image_path = os.path.join(directory, image_info.get("image_name", ""))
+        if os.path.isfile(image_path):
+            image_hashes[image_info["image_name"]] = f"{judge_key}:{image_hash(image_path)}"
 
-            if_unsafe = is_img_unsafe(mode="path", image=os.path.join(directory, image_info["image_name"]))
-            if if_unsafe is None:
-                raise ValueError("Something went undeniably and profoundly wrong - "
-                                 "so simple yet spectacularly disastrous in its failure.")
+        if image_hashes.get(image_info.get("image_name")) in safety_cache:
+            image_info["unsafe"] = safety_cache[image_hashes[image_info["image_name"]]]
+            cached_results.append((image_info, image_info["unsafe"]))
+        else:
+            unchecked_image_info_list.append(image_info)
 
-            image_info["unsafe"] = if_unsafe
+    if judge == "local":
+        results = local_safety_check(directory, unchecked_image_info_list)
+    elif batch:
+        results = batch_safety_check(directory, unchecked_image_info_list)
+    else:
+        results = concurrent_safety_check(directory, unchecked_image_info_list)
 
-            if if_unsafe:
+    new_verdicts = {}
+    try:
+        for image_info, if_unsafe in itertools.chain(cached_results, results):
+            # Collect new verdicts for the cache
+            cache_key = image_hashes.get(image_info.get("image_name"))
+            if if_unsafe is not None and cache_key is not None and cache_key not in safety_cache:
+                new_verdicts[cache_key] = if_unsafe
+
+            if if_unsafe is None:
+                pass
+            elif if_unsafe:
                 cnt_unsafe += 1
                 pbar.set_postfix_str("Unsafe")
-                if "image_name" in image_info:
-                    unsafe_image_names.append(image_info["image_name"])
+                unsafe_image_names.append(image_info["image_name"])
             else:
                 cnt_safe += 1
                 pbar.set_postfix_str("Safe")
 
-        except OpenAIError as e:
-            print(e)
-        except FileNotFoundError:
-            print(f"Image '{image_info["image_name"]}' is not in the directory")
-        except ValueError as e:
-            print(e)
-        finally:
             pbar.update(1)
+    finally:
+        # Save the new verdicts once, even if the run is interrupted
+        if new_verdicts:
+            update_safety_cache(cache_path, new_verdicts)
 
     # Copy all unsafe images into a different directory
     for image_name in unsafe_image_names:
@@ -122,10 +528,15 @@ def img_safety_check(directory):
 
         # Check if the file exists before moving
         if os.path.isfile(image_path):
-            shutil.copy(image_path, unsafe_images_path)
+            # Hardlink instead of copying the data, unless on a different filesystem
+            try:
+                os.link(image_path, os.path.join(unsafe_images_path, image_name))
+            except OSError:
+                shutil.copy(image_path, unsafe_images_path)
         else:
             print(f"Image '{image_name}' does not exist in '{directory}'")
 
     pbar.close()
-    print(f"Found {cnt_unsafe} / {cnt_unsafe + cnt_safe} images unsafe. Copied to '{unsafe_images_path}'.")
+    tqdm.write(f"{directory}: Found {cnt_unsafe} / {cnt_unsafe + cnt_safe} images unsafe. "
+               f"Copied to '{unsafe_images_path}'.")
     return cnt_unsafe, cnt_safe
@@ -0,0 +1,13 @@
+import importlib.util
+import httpx
+from dotenv import load_dotenv
+from openai import OpenAI, DefaultHttpxClient
+
+load_dotenv()
+
+# One connection pool shared by the OpenAI API calls and the image downloads.
+# HTTP/2 needs the optional h2 package (httpx[http2]), otherwise fall back to HTTP/1.1.
+# No global timeout, so the OpenAI calls keep the SDK default one.
+http_client = DefaultHttpxClient(http2=importlib.util.find_spec("h2") is not None,
+                                 limits=httpx.Limits(max_connections=64))
+client = OpenAI(http_client=http_client)
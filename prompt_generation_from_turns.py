@@ -14,27 +14,23 @@ def create_DB(path):
     
 
 def generate_prompts(df):
-    prompts = []
+    df = df[df['Status'] != 'y']
+    turn1, turn2 = df['Turn 1'].astype(object), df['Turn 2'].astype(object)
+    has_turn3 = df['Turn 3'].notna()
+    turn3 = df['Turn 3'].fillna("").astype(object)
 
-    for i, row in df.iterrows():
-        if row['Status'] == 'y':
-            continue
-        # turn 1
-        prompt_request1 = "Earlier, I asked you to generate an image of " + row['Turn 1'] + "\n"
-        prompt_answer1 = "You gave a picture of " + row['Turn 1'] + "\n"
-        # turn 2
-        prompt_request2 = "Then, I asked you to add " + row['Turn 2'] + "\n"
-        prompt_answer2 = "You generated an illustration of " + row['Turn 1'] + " with " + row['Turn 2'] + "\n"
-        # turn 3
-        if pd.isnull(row['Turn 3']):
-            prompt_request3 = ""
-            prompt_answer3 = ""
-        else:
-            prompt_request3 = "Finally, I asked you to include " + row['Turn 3'] + "\n"
-            prompt_answer3 = "You created a drawing of " + row['Turn 1'] + " with " + row['Turn 2'] + " with " + row['Turn 3'] + "\n"
-        # final turn (generation request)
-        prompt_request4 = "Now, I want you to add a frame to the image"
-        # combine
-        prompts.append(prompt_request1 + prompt_answer1 + prompt_request2 + prompt_answer2 + prompt_request3 + prompt_answer3 + prompt_request4)
+    # turn 1
+    prompt_request1 = "Earlier, I asked you to generate an image of " + turn1 + "\n"
+    prompt_answer1 = "You gave a picture of " + turn1 + "\n"
+    # turn 2
+    prompt_request2 = "Then, I asked you to add " + turn2 + "\n"
+    prompt_answer2 = "You generated an illustration of " + turn1 + " with " + turn2 + "\n"
+    # turn 3 (empty if there is no third turn)
+    prompt_request3 = ("Finally, I asked you to include " + turn3 + "\n").where(has_turn3, "")
+    prompt_answer3 = ("You created a drawing of " + turn1 + " with " + turn2 + " with " + turn3 + "\n").where(has_turn3, "")
+    # final turn (generation request)
+    prompt_request4 = "Now, I want you to add a frame to the image"
+    # combine
+    prompts = prompt_request1 + prompt_answer1 + prompt_request2 + prompt_answer2 + prompt_request3 + prompt_answer3 + prompt_request4
 
-    return prompts
\ No newline at end of file
+    return prompts.tolist()
\ No newline at end of file